@@ -1,7 +1,13 @@
+from bisect import bisect_right
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from graphlib import TopologicalSorter
 from math import inf, isinf
-from multiprocessing import Pool
-from typing import (Callable, Generator, Hashable, List, NamedTuple, Set,
+from multiprocessing import Value
+from multiprocessing.sharedctypes import Synchronized
+from os import cpu_count
+from typing import (Callable, Dict, Hashable, List, NamedTuple, Optional, Set,
                     Tuple, Union)
 
 _Itemize = Callable[[int], int]
@@ -31,12 +37,13 @@ class Pattern(NamedTuple):
     """Mined pattern
 
     Attributes:
+        sequence: pairs of pattern, a tuple so that patterns are hashable
         support: count of pattern occcurence
         whole_interval: interval from begining to the end 
             based on itemized intervals
     """
 
-    sequence: List[Pair]
+    sequence: Tuple[Pair, ...]
     support: int
     whole_interval: int
 
@@ -52,12 +59,197 @@ def transform(sequences: List[_BuildInSequence]) -> List[List[Item]]:
             for sequence in sequences]
 
 
+class _ItemizeCache(dict):
+    """Memoized itemize function, look up the code of an itemized interval
+    with `cache[interval]` and the itemized interval with
+    `cache.decode[code]`.
+
+    Itemized intervals are coded as dense integers in the order they are
+    first seen, so that codes compare equal exactly when itemized intervals
+    do and pack into integer keys whatever type itemize returns, e.g. float.
+    Codes are only meaningful within the process assigning them.
+
+    Intervals are itemized lazily, the first time they are looked up, so
+    itemize is only called on intervals mining needs. A dict subclass
+    instead of `functools.lru_cache` so that it stays picklable for
+    multiprocessing.
+    """
+
+    def __init__(self, itemize: _Itemize):
+        super().__init__()
+        self.itemize = itemize
+        self.encode: Dict[int, int] = {}
+        self.decode: List[int] = []
+
+    def __missing__(self, interval: int) -> int:
+        itemized = self.itemize(interval)
+        code = self.encode.get(itemized)
+        if code is None:
+            code = self.encode[itemized] = len(self.decode)
+            self.decode.append(itemized)
+
+        self[interval] = code
+        return code
+
+
+class _Postfix(NamedTuple):
+    """Postfix of an original sequence, projected without copying items.
+
+    sequence: index of the original sequence
+    position: index of the item matched by the last projector, the postfix
+        consists of its head and every item after it
+    head: index into sorted elements of the matched item where elements
+        after the projector, named head, begin
+    """
+
+    sequence: int
+    position: int
+    head: int
+
+
+class _Database(NamedTuple):
+    """Sequence database in both horizontal and vertical layout.
+
+    Elements are encoded as integer ids, ascending in the order of elements
+    so that sorting ids sorts elements. Items are stored column-wise, one
+    list of intervals and one list of itemsets per sequence.
+
+    intervals: interval of each item, per sequence
+    itemsets: sorted element ids of each item, per sequence
+    id_lists: for each element id, positions of items containing it,
+        keyed by sequence index
+    eligibles: positions of non-empty items whose interval from the item
+        before satisfies the interval constraints, per sequence
+    elements: distinct elements indexed by their ids
+    itemized: codes of itemized intervals, look up with `itemized[interval]`
+    min_whole_itemized: itemized minimum whole interval
+    max_whole_itemized: itemized maximum whole interval, None if unbounded
+    """
+
+    intervals: List[List[int]]
+    itemsets: List[List[Tuple[int, ...]]]
+    id_lists: List[Dict[int, List[int]]]
+    eligibles: List[List[int]]
+    elements: List[Hashable]
+    itemized: _ItemizeCache
+    min_whole_itemized: int
+    max_whole_itemized: Optional[int]
+
+
+_ProjectedDatabase = List[List[_Postfix]]
+
+# Minimal share of database sequences left in a projected database for its
+# subtree to be handed to an idle worker as a separate multiprocessing task.
+# Every task costs a round trip through the parent, so only large subtrees
+# are worth it.
+_SPLIT_FRACTION = 0.25
+
+
+class _Subtree(NamedTuple):
+    """Unmined subtree of the search space.
+
+    whole_interval: whole interval of prefix
+    """
+
+    projected_db: _ProjectedDatabase
+    prefix: Tuple[Pair, ...]
+    whole_interval: int
+
+
+def _sort_elements(
+        elements: Set[Hashable],
+        sequences: Union[List[_Sequence], List[_BuildInSequence]]
+) -> List[Hashable]:
+    """Sort elements in an order agreeing with `<` within every item.
+
+    Elements are sorted as a whole if they are comparable with one another.
+    Otherwise, e.g. integer codes mixed with string labels, only elements
+    sharing an item need to be, so the orders of items are merged instead.
+    """
+    try:
+        return sorted(elements)
+    except TypeError:
+        pass
+
+    predecessors = {element: set() for element in elements}
+    for sequence in sequences:
+        for _, item_elements in sequence:
+            ordered = sorted(element for element in item_elements
+                             if element in predecessors)
+            for previous, element in zip(ordered, ordered[1:]):
+                predecessors[element].add(previous)
+
+    return list(TopologicalSorter(predecessors).static_order())
+
+
+def _build_database(sequences: Union[List[_Sequence], List[_BuildInSequence]],
+                    itemized: _ItemizeCache, min_support: int,
+                    min_interval: int, max_interval: int,
+                    min_whole_itemized: int,
+                    max_whole_itemized: Optional[int]) -> _Database:
+    """Encode elements of every item as sorted ids once, so that projections
+    never need to sort or hash the original elements again, and index
+    positions of each element.
+
+    Sequences are read as (interval, elements) pairs, both items and
+    build-in tuples are encoded directly without transforming them first.
+    Elements supported by fewer than `min_support` sequences can not be
+    part of any pattern and are left out. Their items are kept, possibly
+    empty, as the interval constraints apply between adjacent items.
+
+    The interval constraints only compare an item with the one before it,
+    so items satisfying them are indexed up front as eligible.
+    """
+    supports = Counter(
+        element for sequence in sequences
+        for element in {
+            element for _, item_elements in sequence
+            for element in item_elements
+        })
+    elements = _sort_elements(
+        {
+            element for element, support in supports.items()
+            if support >= min_support
+        }, sequences)
+    element_ids = {element: i for i, element in enumerate(elements)}
+
+    intervals = []
+    itemsets = []
+    id_lists = [{} for _ in elements]
+    eligibles = []
+    for sid, sequence in enumerate(sequences):
+        sequence_intervals = []
+        sequence_itemsets = []
+        eligible = []
+        for position, (interval, item_elements) in enumerate(sequence):
+            itemset = tuple(
+                sorted(element_ids[element]
+                       for element in item_elements
+                       if element in element_ids))
+            if (itemset and position > 0 and min_interval <=
+                    interval - sequence_intervals[-1] <= max_interval):
+                eligible.append(position)
+
+            sequence_intervals.append(interval)
+            sequence_itemsets.append(itemset)
+
+            for i in itemset:
+                id_lists[i].setdefault(sid, []).append(position)
+
+        intervals.append(sequence_intervals)
+        itemsets.append(sequence_itemsets)
+        eligibles.append(eligible)
+
+    return _Database(intervals, itemsets, id_lists, eligibles, elements,
+                     itemized, min_whole_itemized, max_whole_itemized)
+
+
 class Gspmi:
     """Algorithm object for 
     Generailized Sequential Pattern Mining with Interval.
 
     Attributes:
-        itemize: itemize function
+        itemize: itemize function, mapping an interval to an integer
         min_support: minimal count of pattern occurence.
         min_interval: minimum interval between each adjacent items
         max_interval: maximum interval between each adjacent items
@@ -92,121 +284,202 @@ class Gspmi:
         self.multiprocessing = multiprocessing
         self.n_processes = n_processes
 
-    def _generate_postfixes(
-            self,
-            sequence: _Sequence,
-            projector: Pair,
-            level1: bool = False) -> Generator[Item, None, None]:
-        """Yield postfixs according to projector.
-
-        The function will yield all element-matched postfix from begining for 
-        level1 == True; otherwise only one exactly interval-and-element 
-        matched postfix. If no matched, yield nothing.
-        """
-
-        def exclude(elements):
-            elements = sorted(elements)
-            return set(elements[elements.index(projector.element) + 1:])
-
-        for i, (interval, elements) in enumerate(sequence):
-            if (projector.element in elements and
-                (level1 or self.itemize(interval) == projector.interval)):
-                head = exclude(elements)
-                postfix = [Item(0, head)] if head else []
-
-                postfix.extend(
-                    Item(i - interval, e) for i, e in sequence[i + 1:])
-                yield postfix
-
-                if not level1:
-                    break
-
-    def _project_level1(self, sequences: List[_Sequence],
-                        projector: Pair) -> List[List[List[Item]]]:
+    def _project_level1(self, database: _Database,
+                        element: int) -> _ProjectedDatabase:
         """Project from initial sequence database.
 
-        Each sequence in database will be project to a list of postfix 
-        named projected database.
+        Each sequence in database will be project to a list of postfix
+        named projected database, one postfix for every item containing
+        the element id. Those items are read straight from the id-list of
+        the element.
         """
-        projected_db = []
-        for sequence in sequences:
-            if (postfixes := list(
-                    self._generate_postfixes(sequence, projector,
-                                             level1=True))):
-                projected_db.append(postfixes)
-
-        return projected_db
-
-    def _project(self, projected_db: List[List[_Sequence]],
-                 projector: Pair) -> List[List[_Sequence]]:
-        """Project projected database to the next level by projector."""
-        child_projected_db = []
-        for sequences in projected_db:
-            projected_sequences = []
-
-            for sequence in sequences:
-                postfix = next(self._generate_postfixes(sequence, projector),
-                               None)
-                if postfix:
-                    projected_sequences.append(postfix)
+        return [[
+            _Postfix(sid, position,
+                     bisect_right(database.itemsets[sid][position], element))
+            for position in positions
+        ] for sid, positions in database.id_lists[element].items()]
+
+    def _project(self, database: _Database, projected_db: _ProjectedDatabase,
+                 code: int, element: int) -> _ProjectedDatabase:
+        """Project projected database to the next level by the projector, the
+        code of an itemized interval and an element id.
+
+        Each postfix is projected to the first item, head included, whose
+        interval and elements match the projector. Candidate items are
+        taken from the id-list of the projector element, joined on the
+        sequence index, rather than by scanning the whole postfix.
+        """
+        itemized = database.itemized
+        head_matched = itemized[0] == code
+        id_list = database.id_lists[element]
 
-            if projected_sequences:
-                child_projected_db.append(projected_sequences)
+        child_projected_db = []
+        for postfixes in projected_db:
+            sid = postfixes[0].sequence
+            positions = id_list.get(sid)
+            if positions is None:
+                # Element absent from the sequence, no postfix can match.
+                continue
+
+            intervals = database.intervals[sid]
+            itemsets = database.itemsets[sid]
+            projected_postfixes = []
+
+            for _, position, head in postfixes:
+                itemset = itemsets[position]
+                # Head holds the elements greater than the one before it.
+                if (head_matched and element in itemset
+                        and element > itemset[head - 1]):
+                    projected_postfixes.append(
+                        _Postfix(sid, position,
+                                 bisect_right(itemset, element, head)))
+                    continue
+
+                base = intervals[position]
+                for i in positions[bisect_right(positions, position):]:
+                    if itemized[intervals[i] - base] == code:
+                        projected_postfixes.append(
+                            _Postfix(sid, i, bisect_right(itemsets[i],
+                                                          element)))
+                        break
+
+            if projected_postfixes:
+                child_projected_db.append(projected_postfixes)
 
         return child_projected_db
 
-    def _mine_subpatterns(self, projected_db: List[List[_Sequence]],
-                          prefix: List[Pair]) -> List[Pattern]:
-        """Recursivly mine sub patterns.
+    def _count_pairs(self,
+                     database: _Database,
+                     projected_db: _ProjectedDatabase,
+                     max_itemized: float = inf) -> Counter:
+        """Count sequences supporting each (interval, element) pair that
+        satisfies the interval constraints in projected database.
+
+        Candidates are counted as packed integer keys
+        `code * len(database.elements) + element`, where code is the code of
+        the itemized interval, cheaper to build and hash than tuples, and only
+        decoded once they turn out to be frequent.
 
         Args:
-            prefix: list of projectors generate during projections
+            max_itemized: maximal itemized interval of pairs to count, pairs
+                beyond it would exceed the maximum whole interval
         """
+        # Hot loop of mining, attributes are bound to locals up front.
+        itemized = database.itemized
+        decode = itemized.decode
+        n_elements = len(database.elements)
+        head_code = itemized[0]
+        head_offset = head_code * n_elements
+        head_allowed = (self.min_interval <= 0 <= self.max_interval
+                        and decode[head_code] <= max_itemized)
+
         counter = Counter()
-        for sequences in projected_db:
+        for postfixes in projected_db:
+            sid = postfixes[0].sequence
+            intervals = database.intervals[sid]
+            itemsets = database.itemsets[sid]
+            eligible = database.eligibles[sid]
             pairs = set()
+            update = pairs.update
 
-            for sequence in sequences:
-                previous = 0
-                for interval, elements in sequence:
-                    if self.min_interval <= interval - previous <= self.max_interval:
-                        pairs.update(
-                            Pair(self.itemize(interval), e) for e in elements)
+            for _, position, head in postfixes:
+                if head_allowed:
+                    update(map(head_offset.__add__, itemsets[position][head:]))
 
-                    previous = interval
+                # Items are eligible regardless of the postfix, those after
+                # its position are found by bisection.
+                base = intervals[position]
+                for i in eligible[bisect_right(eligible, position):]:
+                    code = itemized[intervals[i] - base]
+                    if decode[code] <= max_itemized:
+                        offset = code * n_elements
+                        update(map(offset.__add__, itemsets[i]))
 
             counter.update(pairs)
 
-        patterns = []
-        for pair, support in counter.items():
-            whole_interval = sum(i for i, p in prefix) + pair.interval
-            if (support >= self.min_support and
-                (isinf(self.max_whole_interval)
-                 or whole_interval <= self.itemize(self.max_whole_interval))):
-                child_projected_db = self._project(projected_db, pair)
+        return counter
 
-                patterns.extend(
-                    self._mine_subpatterns(child_projected_db,
-                                           prefix + [pair]))
+    def _mine_subpatterns(
+            self,
+            database: _Database,
+            subtree: _Subtree,
+            split: Optional[Callable[[List[_Subtree]], None]] = None
+    ) -> List[Pattern]:
+        """Mine sub patterns of subtree depth first.
 
-                if whole_interval >= self.itemize(self.min_whole_interval):
-                    patterns.append(
-                        Pattern(prefix + [pair], support, whole_interval))
+        An explicit stack of subtrees is used instead of recursion.
+
+        Args:
+            split: if given, called with the stack before mining each
+                subtree, it may take unmined subtrees off the stack so that
+                they can be scheduled on other workers
+        """
+        # Constant across the whole subtree, bound once rather than looked
+        # up on every candidate.
+        min_support = self.min_support
+        min_whole_itemized = database.min_whole_itemized
+        max_whole_itemized = database.max_whole_itemized
+        n_elements = len(database.elements)
+        decode = database.itemized.decode
+
+        patterns = []
+        stack = [subtree]
+        while stack:
+            if split is not None:
+                split(stack)
+
+            projected_db, prefix, prefix_interval = stack.pop()
+            # Pairs which would exceed the maximum whole interval are never
+            # counted, rather than counted and rejected.
+            max_itemized = (inf if max_whole_itemized is None else
+                            max_whole_itemized - prefix_interval)
+            counter = self._count_pairs(database, projected_db, max_itemized)
+
+            for key, support in counter.items():
+                if support < min_support:
+                    continue
+
+                code, element = divmod(key, n_elements)
+                interval = decode[code]
+                whole_interval = prefix_interval + interval
+
+                pair = Pair(interval, database.elements[element])
+
+                # Shared by the pattern and its subtree.
+                sequence = prefix + (pair,)
+
+                # A sub pattern is supported by at most every sequence left
+                # in the child projected database, skip it when too few.
+                child_projected_db = self._project(database, projected_db,
+                                                   code, element)
+                if len(child_projected_db) >= min_support:
+                    stack.append(
+                        _Subtree(child_projected_db, sequence, whole_interval))
+
+                if whole_interval >= min_whole_itemized:
+                    patterns.append(Pattern(sequence, support, whole_interval))
 
         return patterns
 
-    def _mine_subpatterns_level1(self, sequences: List[_Sequence],
-                                 element: Hashable,
-                                 support: int) -> List[Pattern]:
+    def _mine_subpatterns_level1(
+            self,
+            database: _Database,
+            element: int,
+            support: int,
+            split: Optional[Callable[[List[_Subtree]], None]] = None
+    ) -> List[Pattern]:
         patterns = []
 
         if support >= self.min_support:
-            pair = Pair(0, element)
+            pair = Pair(0, database.elements[element])
             if pair.interval >= self.min_whole_interval:
-                patterns.append(Pattern([pair], support, 0))
+                patterns.append(Pattern((pair,), support, 0))
 
-            projected_db = self._project_level1(sequences, pair)
-            patterns.extend(self._mine_subpatterns(projected_db, [pair]))
+            projected_db = self._project_level1(database, element)
+            patterns.extend(
+                self._mine_subpatterns(database,
+                                       _Subtree(projected_db, (pair,), 0),
+                                       split))
 
         return patterns
 
@@ -215,35 +488,134 @@ class Gspmi:
     ) -> List[Pattern]:
         """Run the algorithm and mine patterns.
         
-        Transform sequences if passing with build-in types.
+        Sequences may be passed with build-in types as well.
         """
-        if len(sequences) > 0 and not isinstance(sequences[0][0], Item):
-            sequences = transform(sequences)
+        # Itemized per call, so that bounds set after construction apply.
+        min_whole_itemized = self.itemize(self.min_whole_interval)
+        max_whole_itemized = (None if isinf(self.max_whole_interval) else
+                              self.itemize(self.max_whole_interval))
 
-        counter = Counter()
-        for sequence in sequences:
-            elements = set()
-            for item in sequence:
-                elements.update(item.elements)
+        # Memoized per call, intervals of one database are of no use to the
+        # next one.
+        database = _build_database(sequences, _ItemizeCache(self.itemize),
+                                   self.min_support, self.min_interval,
+                                   self.max_interval, min_whole_itemized,
+                                   max_whole_itemized)
 
-            counter.update(elements)
+        # Support of an element is the count of sequences in its id-list.
+        supports = [len(id_list) for id_list in database.id_lists]
 
         patterns = []
 
         if not self.multiprocessing:
-            for element, support in counter.items():
+            for element, support in enumerate(supports):
                 subpatterns = self._mine_subpatterns_level1(
-                    sequences, element, support)
+                    database, element, support)
                 patterns.extend(subpatterns)
         else:
-            results = []
-            with Pool(self.n_processes) as pool:
-                for element, support in counter.items():
-                    result = pool.apply_async(self._mine_subpatterns_level1,
-                                              (sequences, element, support))
-                    results.append(result)
-
-                for result in results:
-                    patterns.extend(result.get())
+            # Longest processing time first: elements with the highest
+            # support tend to root the largest subtrees.
+            elements = [
+                element for element in sorted(range(len(supports)),
+                                              key=supports.__getitem__,
+                                              reverse=True)
+                if supports[element] >= self.min_support
+            ]
+
+            # Search trees are highly skewed, so workers hand large subtrees
+            # back to be rescheduled, but only while fewer tasks are pending
+            # than there are workers. The count of pending tasks is shared
+            # with the workers. The database is handed to each worker once,
+            # by the pool initializer, rather than pickled with every task.
+            n_processes = self.n_processes or cpu_count() or 1
+            n_tasks = Value('i', len(elements))
+            with ProcessPoolExecutor(n_processes,
+                                     initializer=_init_worker,
+                                     initargs=(self, database, n_processes,
+                                               n_tasks)) as executor:
+                futures = {
+                    executor.submit(_mine_level1_task, element,
+                                    supports[element])
+                    for element in elements
+                }
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    with n_tasks.get_lock():
+                        n_tasks.value -= len(done)
+
+                    # Subtrees handed back are already counted as pending.
+                    for future in done:
+                        subpatterns, subtrees = future.result()
+                        patterns.extend(subpatterns)
+                        futures.update(
+                            executor.submit(_mine_subtree_task, subtree)
+                            for subtree in subtrees)
 
         return patterns
+
+
+# State of a multiprocessing worker, set once by `_init_worker`.
+_worker_gspmi: Optional[Gspmi] = None
+_worker_database: Optional[_Database] = None
+_worker_n_processes = 0
+# Count of tasks submitted or handed back and not finished yet, shared by
+# the parent and every worker.
+_worker_n_tasks: Optional[Synchronized] = None
+
+
+def _init_worker(gspmi: Gspmi, database: _Database, n_processes: int,
+                 n_tasks: Synchronized):
+    global _worker_gspmi, _worker_database, _worker_n_processes
+    global _worker_n_tasks
+    _worker_gspmi = gspmi
+    _worker_database = database
+    _worker_n_processes = n_processes
+    _worker_n_tasks = n_tasks
+
+
+def _hand_back(subtrees: List[_Subtree], stack: List[_Subtree]):
+    """Move large subtrees from the bottom of stack to subtrees, one for
+    each idle worker, that is for each process without a pending task.
+
+    The bottom of the stack holds the shallowest subtrees, which tend to
+    be the largest. The top one is left to be mined next.
+    """
+    idle = _worker_n_processes - _worker_n_tasks.value
+    if idle <= 0:
+        return
+
+    split_size = _SPLIT_FRACTION * len(_worker_database.intervals)
+    large = [
+        i for i, subtree in enumerate(stack[:-1])
+        if len(subtree.projected_db) >= split_size
+    ][:idle]
+    if not large:
+        return
+
+    # Counted as pending right away, so that other workers do not hand
+    # back subtrees for the same idle workers.
+    with _worker_n_tasks.get_lock():
+        _worker_n_tasks.value += len(large)
+
+    for i in reversed(large):
+        subtrees.append(stack.pop(i))
+
+
+def _mine_level1_task(element: int,
+                      support: int) -> Tuple[List[Pattern], List[_Subtree]]:
+    """Worker task mining patterns starting with element, large subtrees are
+    returned unmined to be rescheduled while workers are idle."""
+    subtrees = []
+    patterns = _worker_gspmi._mine_subpatterns_level1(
+        _worker_database, element, support, partial(_hand_back, subtrees))
+    return patterns, subtrees
+
+
+def _mine_subtree_task(
+        subtree: _Subtree) -> Tuple[List[Pattern], List[_Subtree]]:
+    """Worker task mining a subtree split from another task, large subtrees
+    are returned unmined to be rescheduled while workers are idle."""
+    subtrees = []
+    patterns = _worker_gspmi._mine_subpatterns(_worker_database, subtree,
+                                               partial(_hand_back, subtrees))
+    return patterns, subtrees
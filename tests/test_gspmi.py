@@ -1,4 +1,8 @@
-from math import log2
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from math import inf, log2
+
+import pytest
 
 from intseqpat.gspmi import Gspmi, Item, Pair, Pattern, transform
 
@@ -35,82 +39,81 @@ def _itemize(t):
     return t // 86400
 
 
+# Shared by the mining tests, `Item` input is built with `transform`.
+_BASIC_SEQUENCES = [
+    [(0, {'a'}), (86400, {'a', 'b', 'c'}), (259200, {'a', 'c'})],
+    [(0, {'a', 'd'}), (259200, {'c'})],
+    [(0, {'a', 'e', 'f'}), (172800, {'a', 'b'})],
+]
+_BASIC_PATTERNS = [
+    Pattern((Pair(0, 'a'),), 3, 0),
+    Pattern((Pair(0, 'b'),), 2, 0),
+    Pattern((Pair(0, 'c'),), 2, 0),
+    Pattern((Pair(0, 'a'), Pair(0, 'b')), 2, 0),
+    Pattern((Pair(0, 'a'), Pair(2, 'a')), 2, 2),
+]
+
+
+# Built once at import, only read by the tests.
+_SEQUENCES_COMPLEX = [
+    [
+        Item(0, {'a'}),
+        Item(1, {'a', 'b', 'c'}),
+        Item(4, {'a'}),
+        Item(12, {'b', 'c'}),
+        Item(44, {'a', 'b'}),
+        Item(45, {'a', 'b'}),
+        Item(67, {'b', 'c'}),
+    ],
+    [
+        Item(0, {'a'}),
+        Item(1, {'a'}),
+        Item(7, {'a', 'b'}),
+        Item(14, {'a', 'b', 'c'}),
+        Item(77, {'a'}),
+        Item(78, {'b'}),
+    ],
+    [
+        Item(0, {'a'}),
+        Item(6, {'a', 'b', 'c'}),
+        Item(10, {'b', 'c'}),
+        Item(66, {'a', 'c'}),
+        Item(67, {'b', 'c'}),
+    ],
+    [
+        Item(0, {'a'}),
+        Item(1, {'a', 'b', 'c'}),
+        Item(79, {'a', 'b'}),
+    ],
+    [
+        Item(0, {'a'}),
+        Item(1, {'a', 'b', 'c'}),
+        Item(127, {'a', 'b'}),
+    ],
+]
+
+
 class TestGspmi:
 
-    def test_basic_mine_patterns(self):
-        sequences = [
-            [
-                Item(0, {'a'}),
-                Item(86400, {'a', 'b', 'c'}),
-                Item(259200, {'a', 'c'}),
-            ],
-            [
-                Item(0, {'a', 'd'}),
-                Item(259200, {'c'}),
-            ],
-            [
-                Item(0, {'a', 'e', 'f'}),
-                Item(172800, {'a', 'b'}),
-            ],
-        ]
-        gspmi = Gspmi(itemize=lambda i: i // 86400,
+    @pytest.mark.parametrize('sequences', [
+        pytest.param(transform(_BASIC_SEQUENCES), id='items'),
+        pytest.param(_BASIC_SEQUENCES, id='build-in'),
+    ])
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_basic_mine_patterns(self, sequences, multiprocessing):
+        gspmi = Gspmi(itemize=_itemize,
                       min_support=2,
-                      max_interval=172800)
-        expected = [
-            Pattern([Pair(0, 'a')], 3, 0),
-            Pattern([Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'c')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(2, 'a')], 2, 2),
-        ]
+                      max_interval=172800,
+                      multiprocessing=multiprocessing)
 
         result = gspmi.mine_patterns(sequences)
-        assert sorted(result) == sorted(expected)
+        assert Counter(result) == Counter(_BASIC_PATTERNS)
 
     def test_complex_mine_patterns(self):
         # Only make sure every found patterns is actually exists.
-        a = 'a'
-        b = 'b'
-        c = 'c'
-        sequences = [
-            [
-                Item(0, {a}),
-                Item(1, {a, b, c}),
-                Item(4, {a}),
-                Item(12, {b, c}),
-                Item(44, {a, b}),
-                Item(45, {a, b}),
-                Item(67, {b, c}),
-            ],
-            [
-                Item(0, {a}),
-                Item(1, {a}),
-                Item(7, {a, b}),
-                Item(14, {a, b, c}),
-                Item(77, {a}),
-                Item(78, {b}),
-            ],
-            [
-                Item(0, {a}),
-                Item(6, {a, b, c}),
-                Item(10, {b, c}),
-                Item(66, {a, c}),
-                Item(67, {b, c}),
-            ],
-            [
-                Item(0, {a}),
-                Item(1, {a, b, c}),
-                Item(79, {a, b}),
-            ],
-            [
-                Item(0, {a}),
-                Item(1, {a, b, c}),
-                Item(127, {a, b}),
-            ],
-        ]
         itemize = lambda t: int(log2(t + 1))
         gspmi = Gspmi(itemize=itemize, min_support=2)
-        patterns = gspmi.mine_patterns(sequences)
+        patterns = gspmi.mine_patterns(_SEQUENCES_COMPLEX)
 
         def project(projector, postfix):
             # Return projected postfix if exists, otherwise return none
@@ -142,50 +145,202 @@ class TestGspmi:
                 return False
 
         for pattern in patterns:
-            count = sum(match_sequence(pattern, s) for s in sequences)
+            count = sum(
+                match_sequence(pattern, s) for s in _SEQUENCES_COMPLEX)
 
             assert count == pattern.support
 
-    def test_auto_transform(self):
-        a, b, c, d, e, f = 'a', 'b', 'c', 'd', 'e', 'f'
+    def test_interval_constraints(self):
+        # Items of infrequent 'x' and 'y' still bound the intervals between
+        # adjacent items, and heads are not within a positive min_interval.
         sequences = [
-            [(0, {a}), (86400, {a, b, c}), (259200, {a, c})],
-            [(0, {a, d}), (259200, {c})],
-            [(0, {a, e, f}), (172800, {a, b})],
+            [(0, {'a'}), (86400, {'x'}), (172800, {'b'})],
+            [(0, {'a'}), (86400, {'y'}), (172800, {'b'})],
+            [(0, {'a', 'b'}), (86400, {'b'}), (86400, {'a'})],
+            [(0, {'a', 'b'}), (86400, {'b'}), (86400, {'a'})],
         ]
-        gspmi = Gspmi(itemize=lambda i: i // 86400,
+        gspmi = Gspmi(itemize=_itemize,
                       min_support=2,
-                      max_interval=172800)
+                      min_interval=86400,
+                      max_interval=86400)
         expected = [
-            Pattern([Pair(0, 'a')], 3, 0),
-            Pattern([Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'c')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(2, 'a')], 2, 2),
+            Pattern((Pair(0, 'a'),), 4, 0),
+            Pattern((Pair(0, 'b'),), 4, 0),
+            Pattern((Pair(0, 'a'), Pair(1, 'b')), 2, 1),
+            Pattern((Pair(0, 'a'), Pair(2, 'b')), 2, 2),
+            Pattern((Pair(0, 'b'), Pair(1, 'b')), 2, 1),
         ]
 
         result = gspmi.mine_patterns(sequences)
-        assert sorted(result) == sorted(expected)
+        assert Counter(result) == Counter(expected)
 
-    def test_multiprocessing_mine_patterns(self):
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_whole_interval_constraints(self, multiprocessing):
+        # Single pairs fall short of min_whole_interval, patterns spanning
+        # three days exceed max_whole_interval.
+        sequences = [
+            [(0, {'a'}), (86400, {'b'}), (172800, {'c'}), (259200, {'a'})],
+            [(0, {'a'}), (86400, {'b'}), (172800, {'c'}), (259200, {'a'})],
+            [(0, {'a', 'b'}), (172800, {'c'})],
+        ]
+        gspmi = Gspmi(itemize=_itemize,
+                      min_support=2,
+                      min_whole_interval=86400,
+                      max_whole_interval=172800,
+                      multiprocessing=multiprocessing)
+        expected = [
+            Pattern((Pair(0, 'a'), Pair(1, 'b')), 2, 1),
+            Pattern((Pair(0, 'a'), Pair(2, 'c')), 3, 2),
+            Pattern((Pair(0, 'b'), Pair(1, 'c')), 2, 1),
+            Pattern((Pair(0, 'b'), Pair(2, 'a')), 2, 2),
+            Pattern((Pair(0, 'c'), Pair(1, 'a')), 2, 1),
+            Pattern((Pair(0, 'a'), Pair(1, 'b'), Pair(1, 'c')), 2, 2),
+            Pattern((Pair(0, 'b'), Pair(1, 'c'), Pair(1, 'a')), 2, 2),
+        ]
+
+        result = gspmi.mine_patterns(sequences)
+        assert Counter(result) == Counter(expected)
+
+    def test_whole_interval_attributes(self):
+        # Bounds set after construction apply to the next call.
+        gspmi = Gspmi(itemize=_itemize, min_support=2, max_interval=172800)
+        result = gspmi.mine_patterns(_BASIC_SEQUENCES)
+        assert Counter(result) == Counter(_BASIC_PATTERNS)
+
+        gspmi.min_whole_interval = 86400
+        gspmi.max_whole_interval = 172800
+        expected = [Pattern((Pair(0, 'a'), Pair(2, 'a')), 2, 2)]
 
-        a, b, c, d, e, f = 'a', 'b', 'c', 'd', 'e', 'f'
+        result = gspmi.mine_patterns(_BASIC_SEQUENCES)
+        assert Counter(result) == Counter(expected)
+
+        gspmi.max_whole_interval = 86400
+        assert gspmi.mine_patterns(_BASIC_SEQUENCES) == []
+
+    def test_partial_itemize(self):
+        # Itemize only defined on intervals occurring in the sequences.
+        sequences = [[(interval // 43200, elements)
+                      for interval, elements in sequence]
+                     for sequence in _BASIC_SEQUENCES]
+        itemize = {0: 0, 2: 1, 4: 2, 6: 3}.__getitem__
+        gspmi = Gspmi(itemize=itemize, min_support=2, max_interval=4)
+
+        result = gspmi.mine_patterns(sequences)
+        assert Counter(result) == Counter(_BASIC_PATTERNS)
+
+    def test_unsorted_sequences(self):
         sequences = [
-            [(0, {a}), (86400, {a, b, c}), (259200, {a, c})],
-            [(0, {a, d}), (259200, {c})],
-            [(0, {a, e, f}), (172800, {a, b})],
+            [(172800, {'a'}), (0, {'b'}), (86400, {'a', 'b'})],
+            [(86400, {'a'}), (0, {'b'})],
+            [(259200, {'a', 'c'}), (86400, {'b'})],
         ]
         gspmi = Gspmi(itemize=_itemize,
                       min_support=2,
-                      max_interval=172800,
-                      multiprocessing=True)
+                      min_interval=-inf,
+                      min_whole_interval=-259200)
+        expected = [
+            Pattern((Pair(0, 'a'),), 3, 0),
+            Pattern((Pair(0, 'b'),), 3, 0),
+            Pattern((Pair(0, 'a'), Pair(-2, 'b')), 2, -2),
+            Pattern((Pair(0, 'a'), Pair(-1, 'b')), 2, -1),
+        ]
+
+        result = gspmi.mine_patterns(sequences)
+        assert Counter(result) == Counter(expected)
+
+    def test_float_intervals(self):
+        sequences = [
+            [(0.0, {'a'}), (0.5, {'a', 'b'}), (2.0, {'b'})],
+            [(0.0, {'a', 'b'}), (1.5, {'b'})],
+            [(0.25, {'a'}), (1.75, {'b'})],
+        ]
+        gspmi = Gspmi(itemize=int, min_support=2)
+        expected = [
+            Pattern((Pair(0, 'a'),), 3, 0),
+            Pattern((Pair(0, 'b'),), 3, 0),
+            Pattern((Pair(0, 'a'), Pair(0, 'b')), 2, 0),
+            Pattern((Pair(0, 'a'), Pair(1, 'b')), 3, 1),
+            Pattern((Pair(0, 'b'), Pair(1, 'b')), 2, 1),
+            Pattern((Pair(0, 'a'), Pair(0, 'b'), Pair(1, 'b')), 2, 1),
+        ]
+
+        result = gspmi.mine_patterns(sequences)
+        assert Counter(result) == Counter(expected)
+
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_float_timestamps(self, multiprocessing):
+        # Itemizing float timestamps yields float intervals, e.g. 1.0.
+        sequences = [
+            [(0.0, {'a'}), (86400.5, {'a', 'b'}), (172800.25, {'b', 'c'})],
+            [(0.0, {'a', 'c'}), (90000.0, {'b'}), (180000.0, {'c'})],
+            [(3600.0, {'a'}), (100000.0, {'b'}), (200000.0, {'c'})],
+        ]
+        gspmi = Gspmi(itemize=_itemize,
+                      min_support=2,
+                      multiprocessing=multiprocessing)
         expected = [
-            Pattern([Pair(0, 'a')], 3, 0),
-            Pattern([Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'c')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(0, 'b')], 2, 0),
-            Pattern([Pair(0, 'a'), Pair(2, 'a')], 2, 2),
+            Pattern((Pair(0, 'a'),), 3, 0),
+            Pattern((Pair(0, 'b'),), 3, 0),
+            Pattern((Pair(0, 'c'),), 3, 0),
+            Pattern((Pair(0, 'a'), Pair(0.0, 'c')), 2, 0.0),
+            Pattern((Pair(0, 'a'), Pair(1.0, 'b')), 3, 1.0),
+            Pattern((Pair(0, 'a'), Pair(2.0, 'c')), 3, 2.0),
+            Pattern((Pair(0, 'b'), Pair(1.0, 'c')), 2, 1.0),
+            Pattern((Pair(0, 'a'), Pair(1.0, 'b'), Pair(1.0, 'c')), 2, 2.0),
         ]
 
         result = gspmi.mine_patterns(sequences)
-        assert sorted(result) == sorted(expected)
+        assert Counter(result) == Counter(expected)
+
+    def test_mixed_type_elements(self):
+        # Integers are only compared with numbers sharing their items.
+        sequences = [
+            [(0, {1, 2}), (86400, {'a', 'b'}), (86400, {2.5, 3})],
+            [(0, {2, 1}), (86400, {'a'}), (172800, {3, 2.5})],
+        ]
+        gspmi = Gspmi(itemize=_itemize, min_support=2)
+        expected = [
+            Pattern((Pair(0, 1),), 2, 0),
+            Pattern((Pair(0, 2),), 2, 0),
+            Pattern((Pair(0, 2.5),), 2, 0),
+            Pattern((Pair(0, 3),), 2, 0),
+            Pattern((Pair(0, 'a'),), 2, 0),
+            Pattern((Pair(0, 1), Pair(0, 2)), 2, 0),
+            Pattern((Pair(0, 1), Pair(1, 'a')), 2, 1),
+            Pattern((Pair(0, 2), Pair(1, 'a')), 2, 1),
+            Pattern((Pair(0, 1), Pair(0, 2), Pair(1, 'a')), 2, 1),
+            Pattern((Pair(0, 2.5), Pair(0, 3)), 2, 0),
+        ]
+
+        result = gspmi.mine_patterns(sequences)
+        assert Counter(result) == Counter(expected)
+
+    @pytest.mark.parametrize('n_processes, n_tasks', [(1, 3), (4, 4)])
+    def test_multiprocessing_split_subtrees(self, monkeypatch, n_processes,
+                                            n_tasks):
+        # Enough sequences for subtrees to be large enough to split, yet
+        # they are only split into separate tasks for idle workers. The
+        # three level-1 tasks leave one of four workers idle, and one
+        # subtree is handed back for it.
+        submitted = []
+        submit = ProcessPoolExecutor.submit
+
+        def count_submit(executor, fn, *args):
+            submitted.append(fn)
+            return submit(executor, fn, *args)
+
+        monkeypatch.setattr(ProcessPoolExecutor, 'submit', count_submit)
+
+        gspmi = Gspmi(itemize=_itemize,
+                      min_support=40,
+                      max_interval=172800,
+                      multiprocessing=True,
+                      n_processes=n_processes)
+        expected = [
+            Pattern(sequence, support * 20, whole_interval)
+            for sequence, support, whole_interval in _BASIC_PATTERNS
+        ]
+
+        result = gspmi.mine_patterns(_BASIC_SEQUENCES * 20)
+        assert Counter(result) == Counter(expected)
+        assert len(submitted) == n_tasks